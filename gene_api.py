@@ -5,10 +5,13 @@
 
 from flask import Flask, request, send_file
 from collections import Counter, OrderedDict
+from multiprocessing import get_context
 import requests
 import redis
 import json
 import os
+import threading
+import time
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -36,14 +39,297 @@ def get_redis2():
     red2 = redis.Redis(host=redis_ip2, port=6379, db=2, decode_responses=True)
     return red2
 
+def get_redis3():
+    redis_ip3 = os.environ.get('REDIS_IP')
+    if not redis_ip3:
+        raise Exception()
+    red3 = redis.Redis(host=redis_ip3, port=6379, db=3)
+    return red3
+
 rd = get_redis0()
 rd1 = get_redis1()
 rd2 = get_redis2()
+rd3 = get_redis3()
+
+MAX_WORKERS = os.cpu_count() or 1
+SERIAL_LIMIT = 5000
+
+load_lock = threading.Lock()
+worker = {}
+
+def get_workers() -> int:
+    """
+    Returns the number of worker processes used by the ingest pipeline. The value
+    comes from the "workers" query parameter, then the INGEST_WORKERS environment
+    variable, then the number of CPUs on the machine, and is never more than the
+    number of CPUs.
+
+    Args:
+        None.
+
+    Returns:
+        workers (int): Number of worker processes and writer connections.
+
+    Raises:
+        RuntimeError: INGEST_WORKERS is not a positive integer.
+        ValueError: The "workers" query parameter is not a positive integer no
+            greater than MAX_WORKERS.
+    """
+
+    default = os.environ.get('INGEST_WORKERS')
+    if default:
+        try:
+            default = int(default)
+        except ValueError:
+            raise RuntimeError()
+        if default < 1:
+            raise RuntimeError()
+
+    workers = request.args.get('workers')
+    if workers is None:
+        return min(default or MAX_WORKERS, MAX_WORKERS)
+    workers = int(workers)
+    if workers < 1 or workers > MAX_WORKERS:
+        raise ValueError()
+    return workers
+
+def split_bounds(length: int, n: int) -> list:
+    """
+    Splits the indexes of a list into at most n contiguous ranges of roughly
+    equal size.
+
+    Args:
+        length (int): The length of the list.
+        n (int): The number of ranges.
+
+    Returns:
+        bounds (list): List of (start, end) tuples.
+    """
+
+    size = max(1, -(-length // n))
+    return [(i, min(i+size, length)) for i in range(0, length, size)]
+
+def init_worker(docs: list):
+    """
+    Runs once in each worker process. Keeps the parsed genes the process was
+    forked with and opens its own connection to the database, so no connection
+    is shared with the parent.
+
+    Args:
+        docs (list): List of gene dictionaries parsed by the parent.
+
+    Returns:
+        None.
+    """
 
-def get_data():
+    worker['docs'] = docs
+    worker['red'] = get_redis0()
+
+def ingest_worker(bounds: tuple) -> dict:
+    """
+    Runs ingest_chunk in a worker process on the genes and connection set up by
+    init_worker, so only the range goes into the worker and only the partial
+    index comes back out.
+
+    Args:
+        bounds (tuple): The (start, end) range of docs to ingest.
+
+    Returns:
+        result (dict): The partial index and seconds spent in each stage.
+    """
+
+    return ingest_chunk(worker['docs'], bounds, worker['red'])
+
+def ingest_chunk(docs: list, bounds: tuple, red: redis.Redis) -> dict:
+    """
+    Encodes, writes and indexes one range of the parsed genes.
+
+    Args:
+        docs (list): List of gene dictionaries.
+        bounds (tuple): The (start, end) range of docs to ingest.
+        red (redis.Redis): The database to write the genes to.
+
+    Returns:
+        result (dict): The partial index and seconds spent in each stage.
+    """
+
+    chunk = docs[bounds[0]:bounds[1]]
+    timings = {}
+    start = time.perf_counter()
+    records = {item['hgnc_id']: json.dumps(item) for item in chunk}
+    timings['encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_chunk(records, red)
+    timings['write'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = index_chunk(chunk)
+    timings['index'] = time.perf_counter() - start
+    return {'index': index, 'timings': timings}
+
+def index_chunk(chunk: list) -> dict:
+    """
+    Index stage of the ingest pipeline. Runs in a worker process and tabulates
+    the derived views for one chunk of genes.
+
+    Args:
+        chunk (list): List of gene dictionaries.
+
+    Returns:
+        index (dict): Partial year and locus group counts and gene group
+            membership for the chunk.
+    """
+
+    years = Counter()
+    locus = Counter()
+    members = {}
+    names = {}
+    types = {}
+    for item in chunk:
+        years[item['date_approved_reserved'][0:4]] += 1
+        locus[item['locus_group']] += 1
+        gene = int(item['hgnc_id'].split(':')[1])
+        for gid, name in zip(item.get('gene_group_id', []), item.get('gene_group', [])):
+            members.setdefault(gid, []).append(gene)
+            names[gid] = name
+            types.setdefault(gid, Counter())[item['locus_type']] += 1
+    return {'years': years, 'locus': locus, 'members': members, 'names': names, 'types': types}
+
+def merge_indexes(indexes: list) -> dict:
+    """
+    Merges the partial results of index_chunk into dataset-wide counts.
+
+    Args:
+        indexes (list): List of dictionaries returned by index_chunk.
+
+    Returns:
+        index (dict): Year and locus group counts, the gene group adjacency
+            arrays and the gene group size statistics for the whole dataset.
+    """
+
+    years = Counter()
+    locus = Counter()
+    members = {}
+    names = {}
+    types = {}
+    for part in indexes:
+        years.update(part['years'])
+        locus.update(part['locus'])
+        names.update(part['names'])
+        for gid in part['members']:
+            members.setdefault(gid, []).extend(part['members'][gid])
+            types.setdefault(gid, Counter()).update(part['types'][gid])
+
+    groups = {}
+    genes = {}
+    for gid in sorted(members):
+        groups[gid] = np.unique(np.array(members[gid], dtype=np.int32))
+        for gene in groups[gid]:
+            genes.setdefault(int(gene), []).append(gid)
+    genes = {gene: np.array(sorted(genes[gene]), dtype=np.int32) for gene in genes}
+
+    info = {}
+    for gid in groups:
+        info[gid] = {"gene group": names[gid], "size": len(groups[gid]),
+                     "locus types": dict(sorted(types[gid].items()))}
+
+    sizes = np.array([len(groups[gid]) for gid in groups], dtype=np.int32)
+    stats = {"number of groups": len(groups), "genes in groups": len(genes)}
+    if len(sizes) > 0:
+        largest = sorted(groups, key=lambda gid: len(groups[gid]), reverse=True)[0:10]
+        stats.update({"smallest group size": int(sizes.min()),
+                      "largest group size": int(sizes.max()),
+                      "mean group size": round(float(sizes.mean()), 2),
+                      "median group size": float(np.median(sizes)),
+                      "largest groups": {str(gid): len(groups[gid]) for gid in largest}})
+
+    return {'years': dict(sorted(years.items())), 'locus': dict(sorted(locus.items())),
+            'groups': groups, 'genes': genes, 'group_info': info, 'group_stats': stats}
+
+def write_chunk(records: dict, red: redis.Redis, batch: int = 1000) -> int:
+    """
+    Writes records to Redis as MSET commands of at most batch keys each. All of
+    the commands are queued on one pipeline and sent in a single round trip.
+
+    Args:
+        records (dict): Dictionary of keys and values to write.
+        red (redis.Redis): The database to write to.
+        batch (int): Number of keys in each MSET command.
+
+    Returns:
+        count (int): Number of records written.
+    """
+
+    pairs = list(records.items())
+    pipe = red.pipeline(transaction=False)
+    for i in range(0, len(pairs), batch):
+        pipe.mset(dict(pairs[i:i+batch]))
+    pipe.execute()
+    return len(pairs)
+
+def load_data(workers: int) -> dict:
+    """
+    Runs the ingest pipeline. The file is fetched and parsed once, then each
+    worker process encodes, writes and indexes its own ranges of genes, so writes
+    of one range overlap with encoding of the others. Small loads and loads with
+    one worker run the same steps in this process instead.
+
+    The pool is started with fork so the workers get the parsed genes from the
+    memory they were forked with instead of having the whole list pickled to
+    each of them. This forks the threaded Flask process, so the workers only use
+    the inherited list and the connection they open in init_worker, and callers
+    hold load_lock so that only one load forks at a time.
+
+    Args:
+        workers (int): Number of worker processes and writer connections.
+
+    Returns:
+        timings (dict): Seconds spent in each stage. The encode, write and index
+            stages are summed over the workers.
+    """
+
+    timings = {}
+    total = time.perf_counter()
+    start = time.perf_counter()
     response = requests.get(url = 'https://ftp.ebi.ac.uk/pub/databases/genenames/hgnc/json/hgnc_complete_set.json')
-    response = response.json()['response']['docs']
-    return response
+    timings['fetch'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    docs = response.json()['response']['docs']
+    bounds = split_bounds(len(docs), workers * 4)
+    timings['parse'] = time.perf_counter() - start
+
+    if workers == 1 or len(docs) < SERIAL_LIMIT:
+        results = [ingest_chunk(docs, bound, rd) for bound in bounds]
+    else:
+        with get_context('fork').Pool(workers, initializer=init_worker, initargs=(docs,)) as pool:
+            results = list(pool.imap_unordered(ingest_worker, bounds))
+    for stage in ['encode', 'write', 'index']:
+        timings[stage] = sum(result['timings'][stage] for result in results)
+
+    start = time.perf_counter()
+    index = merge_indexes([result['index'] for result in results])
+    timings['index'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    adjacency = {f'group:{gid}': index['groups'][gid].tobytes() for gid in index['groups']}
+    adjacency.update({f'gene:{gene}': index['genes'][gene].tobytes() for gene in index['genes']})
+    rd2.delete('group_stats')
+    rd3.flushdb()
+    write_chunk(adjacency, rd3)
+    pipe = rd2.pipeline()
+    pipe.delete('year_counts', 'locus_counts', 'group_info')
+    pipe.set('year_counts', json.dumps(index['years']))
+    pipe.set('locus_counts', json.dumps(index['locus']))
+    if index['group_info']:
+        pipe.hset('group_info', mapping={gid: json.dumps(index['group_info'][gid]) for gid in index['group_info']})
+    pipe.set('group_stats', json.dumps(index['group_stats']))
+    pipe.execute()
+    timings['write'] += time.perf_counter() - start
+
+    timings['total'] = time.perf_counter() - total
+    return timings
 
 
 @app.route('/data', methods = ['POST', 'GET', 'DELETE'])
@@ -56,12 +342,12 @@ def handle_data():
             the user.
 
     Args:
-        POST: None.
+        POST: workers (int): Number of worker processes used to load the data.
         GET: None.
         DELETE: None.
 
     Returns:
-        POST (str): Returns "Data loaded" message.
+        POST (str): Returns "Data loaded" message with the time of each stage.
         GET (output_list): Returns the data from the database.
         DELETE (str): Returns "Data deleted, there are 0 keys in the db" message.
     """
@@ -74,12 +360,25 @@ def handle_data():
             output_list.append(json.loads(rd.get(item)))
         return output_list
     elif request.method == 'POST':
-        data = get_data()
-        for item in data:
-            key = f'{item["hgnc_id"]}'
-            rd.set(key, json.dumps(item))
-        return f'Data loaded.\n'
+        try:
+            workers = get_workers()
+        except RuntimeError:
+            return ("INGEST_WORKERS must be a positive integer. Please fix the server configuration.\n", 500)
+        except ValueError:
+            return (f"Enter a positive integer no greater than {MAX_WORKERS} for workers.\n", 400)
+        if not load_lock.acquire(blocking=False):
+            return ("Data is already being loaded. Please try again when it finishes.\n", 409)
+        try:
+            timings = load_data(workers)
+        finally:
+            load_lock.release()
+        output = f'Data loaded with {workers} workers.\n'
+        for stage in timings:
+            output += f'   {stage}: {timings[stage]:.2f} s\n'
+        return output
     elif request.method == 'DELETE':
+        rd2.flushdb()
+        rd3.flushdb()
         if len(rd.keys()) < 1:
             return ("No data in the database to delete.\n")
         rd.flushdb()
@@ -104,6 +403,97 @@ def get_gene(hgnc_id: str) -> dict:
     items = json.loads(rd.get(hgnc_id))
     return items
 
+@app.route('/genes/<string:hgnc_id>/related', methods = ['GET'])
+def get_related(hgnc_id: str) -> dict:
+    """
+    A route that returns the gene groups of a specified gene and every other gene
+    that shares at least one of those groups, read from the gene group index.
+
+    Args:
+        hgnc_id (str): The specified hgnc_id.
+
+    Returns:
+        related (dict): Dictionary with the gene groups and related hgnc_ids.
+    """
+
+    if rd.dbsize() == 0:
+        return ("No data in the database. Please use a POST route first.\n")
+    if not rd2.exists('group_stats'):
+        return ("No gene group index in the database. Please POST /data again to build the gene group index.\n")
+    if not rd.exists(hgnc_id):
+        return ("No gene with that HGNC ID in the database.\n", 404)
+
+    gene = int(hgnc_id.split(':')[1])
+    gids = rd3.get(f'gene:{gene}')
+    gids = np.frombuffer(gids, dtype=np.int32) if gids else np.array([], dtype=np.int32)
+
+    groups = []
+    members = [np.array([], dtype=np.int32)]
+    if len(gids) > 0:
+        infos = rd2.hmget('group_info', [int(gid) for gid in gids])
+        arrays = rd3.mget([f'group:{gid}' for gid in gids])
+        for gid, info, array in zip(gids, infos, arrays):
+            if info is None or array is None:
+                continue
+            info = json.loads(info)
+            groups.append({"gene group id": int(gid), "gene group": info["gene group"],
+                           "size": info["size"]})
+            members.append(np.frombuffer(array, dtype=np.int32))
+    others = np.setdiff1d(np.unique(np.concatenate(members)), [gene])
+
+    related = {}
+    related["hgnc_id"] = hgnc_id
+    related["gene groups"] = groups
+    related["related genes"] = [f'HGNC:{other}' for other in others]
+    return related
+
+@app.route('/groups', methods = ['GET'])
+def get_groups() -> dict:
+    """
+    A route that returns the gene group size statistics for the whole dataset.
+
+    Args:
+        None.
+
+    Returns:
+        stats (dict): Dictionary with the gene group size statistics.
+    """
+
+    if rd.dbsize() == 0:
+        return ("No data in the database. Please use a POST route first.\n")
+    stats = rd2.get('group_stats')
+    if stats is None:
+        return ("No gene group index in the database. Please POST /data again to build the gene group index.\n")
+    return json.loads(stats)
+
+@app.route('/groups/<int:group_id>', methods = ['GET'])
+def get_group(group_id: int) -> dict:
+    """
+    A route that returns the name, size, locus types and members of a specified
+    gene group, read from the gene group index.
+
+    Args:
+        group_id (int): The specified gene_group_id.
+
+    Returns:
+        group (dict): Dictionary with all data for the gene group.
+    """
+
+    if rd.dbsize() == 0:
+        return ("No data in the database. Please use a POST route first.\n")
+    if not rd2.exists('group_stats'):
+        return ("No gene group index in the database. Please POST /data again to build the gene group index.\n")
+    info = rd2.hget('group_info', group_id)
+    if info is None:
+        return ("No gene group with that ID in the database.\n", 404)
+
+    members = rd3.get(f'group:{group_id}')
+    members = np.frombuffer(members, dtype=np.int32) if members else np.array([], dtype=np.int32)
+    group = {"gene group id": group_id}
+    group.update(json.loads(info))
+    group["members"] = [f'HGNC:{member}' for member in members]
+    return group
+
 @app.route('/genes', methods = ['GET'])
 def get_genes() -> list:
     """
@@ -147,12 +537,15 @@ def get_image():
     counts = []
     years = []
     if request.method == 'POST':
-        for item in rd.keys():
-            gene = json.loads(rd.get(item))
-            year = gene['date_approved_reserved'][0:4]
-            years.append(year)
-        yeard = dict(Counter(years))
-        yeard = dict(sorted(yeard.items()))
+        if rd2.exists('year_counts'):
+            yeard = json.loads(rd2.get('year_counts'))
+        else:
+            for item in rd.keys():
+                gene = json.loads(rd.get(item))
+                year = gene['date_approved_reserved'][0:4]
+                years.append(year)
+            yeard = dict(Counter(years))
+            yeard = dict(sorted(yeard.items()))
         y = []
         c = []
         for item in yeard:
@@ -204,7 +597,7 @@ def get_help() -> str:
     head4 = "\nget help\n"
 
     one ="   /data (GET)                                Return all the data in the database\n"
-    two ="   /data (POST)                               Post the data to the database\n"
+    two ="   /data?workers=n (POST)                     Post the data to the database using n worker processes\n"
     thr ="   /data (DELETE)                             Delete the data from the database\n"
     fou ="   /genes (GET)                               Return a list of all HGNC IDs\n"
     fiv ="   /genes/<hgnc_id> (GET)                     Returns all of the information for a specified HGNC ID\n"
@@ -216,7 +609,10 @@ def get_help() -> str:
     ele ="   /imagedata (GET)                           Return the data used to generate the image from the /image route\n"
     twe ="   /locusdata (GET)                           Return the number of entries in each locus group\n"
     thi ="   /locus/<hgnc_id> (GET)                     Return the locus group of a specified HGNC ID\n"
-    return intro + head2 + two + sev + head1 + one + fou + fiv + nin + ele+ ten +twe + thi+ head3 + thr + eig + head4 + six
+    fot ="   /genes/<hgnc_id>/related (GET)             Return the genes that share a gene group with a specified HGNC ID\n"
+    fif ="   /groups (GET)                              Return the gene group size statistics for the whole dataset\n"
+    sxt ="   /groups/<group_id> (GET)                   Return the members and size of a specified gene group\n"
+    return intro + head2 + two + sev + head1 + one + fou + fiv + fot + nin + ele+ ten +twe + thi + fif + sxt + head3 + thr + eig + head4 + six
 
 @app.route('/when/<string:hgnc_id>', methods = ['GET'])
 def get_date(hgnc_id: str) -> dict:
@@ -313,6 +709,10 @@ def get_locusdata() -> dict:
 
     if len(rd.keys()) < 1:
         return ("No data in the database. Please use a POST route first.\n")
+    if rd2.exists('locus_counts'):
+        title = {"Locus Group": "Number of Entries"}
+        title.update(json.loads(rd2.get('locus_counts')))
+        return title
     counts = []
     groups = []
     for item in rd.keys():